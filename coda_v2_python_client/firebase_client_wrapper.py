@@ -1,8 +1,14 @@
-import json
-
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
+import collections
+import contextlib
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions
+from google.api_core import retry
+from google.cloud import firestore
 from core_data_modules.logging import Logger
 from core_data_modules.data_models import Message
 from core_data_modules.data_models import CodeScheme
@@ -10,9 +16,51 @@ from core_data_modules.data_models import MessagesMetrics
 
 log = Logger(__name__)
 
+# Firestore clients created by `CodaV2Client.init_client`, shared between all the CodaV2Clients initialised with the
+# same credentials and app name. Guarded by `_init_client_lock`.
+_firestore_clients = dict()  # of (crypto token path, app name) -> google.cloud.firestore.Client
+# Firebase apps created by `CodaV2Client.init_client`, which `CodaV2Client.close` deletes. Apps that already existed
+# when `init_client` was called belong to other code, so are not included. Guarded by `_init_client_lock`.
+_owned_firebase_apps = dict()  # of (crypto token path, app name) -> firebase_admin.App
+_init_client_lock = threading.Lock()
+
 
 class CodaV2Client:
     MAX_SEGMENT_SIZE = 2500
+    SEGMENT_COUNT_CACHE_TTL_SECONDS = 60
+    MAX_SEGMENT_READ_WORKERS = 16
+    CODE_SCHEMES_CONSISTENCY_CHECK_TTL_SECONDS = 60
+    SEGMENT_CACHE_TTL_SECONDS = 60
+    FILLED_SEGMENT_SEQ_NOS_CACHE_TTL_SECONDS = 60
+
+    # Maximum number of writes Firestore allows in a single batched write.
+    MAX_BATCH_WRITES = 500
+
+    # Retry policy for the small single-document reads made when probing segments. The per-attempt timeout is kept
+    # short so that a read which stalls in the slow tail is re-issued rather than holding up the whole probe. A
+    # stalled attempt fails with DeadlineExceeded, so that is retried along with the errors Firestore's own default
+    # policy retries, and the overall deadline matches Firestore's default so slow reads still succeed eventually.
+    # Only use this for unary `DocumentReference.get` calls: streaming reads such as `get_all` apply the timeout to
+    # the whole stream and don't retry errors raised while it is being iterated.
+    SEGMENT_READ_RETRY = retry.Retry(
+        initial=0.05, maximum=1.0, multiplier=2.0, deadline=60.0,
+        predicate=retry.if_exception_type(
+            exceptions.DeadlineExceeded,
+            exceptions.ResourceExhausted,
+            exceptions.InternalServerError,
+            exceptions.TooManyRequests,
+            exceptions.ServiceUnavailable
+        )
+    )
+    SEGMENT_READ_TIMEOUT_SECONDS = 1.5
+
+    # Number of times `add_message_to_dataset` tries to add a message without a transaction before falling back to a
+    # transaction, if another client keeps writing to the same segment first. Between attempts it waits for a random
+    # delay of up to ADD_MESSAGE_RETRY_INITIAL_DELAY_SECONDS, doubling after each attempt up to
+    # ADD_MESSAGE_RETRY_MAX_DELAY_SECONDS, so that conflicting writers spread out rather than colliding again.
+    ADD_MESSAGE_MAX_ATTEMPTS = 5
+    ADD_MESSAGE_RETRY_INITIAL_DELAY_SECONDS = 0.05
+    ADD_MESSAGE_RETRY_MAX_DELAY_SECONDS = 1.0
 
     def __init__(self, client):
         """
@@ -22,9 +70,21 @@ class CodaV2Client:
         :type client: google.cloud.firestore.Firestore
         """
         self._client = client
+        self._datasets_ref = client.collection("datasets")
+        self._segment_counts_ref = client.collection("segment_counts")
+        self._segment_count_cache = dict()  # of dataset id -> (segment count, time.monotonic() when cached)
+        self._code_schemes_checked_at = dict()  # of dataset id -> time.monotonic() when last checked consistent
+        self._segment_cache = dict()  # of segment id -> (segment snapshot, time.monotonic() when cached)
+        # of dataset id -> (dict of filled segment id -> highest sequence number in that segment,
+        #                  time.monotonic() when cached)
+        self._filled_segment_highest_seq_nos = dict()
+        self._metrics_watches = dict()  # of segment id -> google.cloud.firestore_v1.watch.Watch
+        self._watched_metrics = dict()  # of segment id -> latest MessagesMetrics | None seen by the segment's watch
+        self._metrics_watches_lock = threading.Lock()
+        self._batched_writes_state = threading.local()  # .batch: the current thread's `batched_writes` batch, if any
 
     @classmethod
-    def init_client(cls, crypto_token_path, app_name="CodaV2Client"):
+    def init_client(cls, crypto_token_path, app_name="CodaV2Client", client_options=None):
         """
         Inits Coda V2 client
 
@@ -32,19 +92,88 @@ class CodaV2Client:
         :type crypto_token_path: str
         :param app_name: Name to call the Firestore app instance we'll use to connect, defaults to "CodaV2Client"
         :type app_name: str, optional
-        :return: Coda V2 client instance
+        :param client_options: Transport options for the underlying Firestore client, for example to set an
+                               `api_endpoint` that is closer to the caller or to point at an emulator. If None, the
+                               client is created with the default options. Defaults to None.
+        :type client_options: google.api_core.client_options.ClientOptions | dict | None, optional
+        :return: Coda V2 client instance. Clients initialised with the same `crypto_token_path` and `app_name` share
+                 the same underlying Firestore client, which is only created (with `client_options`) on the first call.
+                 An existing Firebase app called `app_name` is only reused if it has the credentials in
+                 `crypto_token_path`; otherwise a ValueError is raised.
         :rtype: CodaV2Client
         """
-        try:
-            firebase_admin.get_app()
-        except ValueError:
-            log.debug("Creating default Firebase app")
-            firebase_admin.initialize_app()
-
-        log.debug(f"Creating Firebase app {app_name}")
-        cred = credentials.Certificate(crypto_token_path)
-        app = firebase_admin.initialize_app(cred, name=app_name)
-        return cls(firestore.client(app))
+        # firebase_admin is only needed to create the Firestore client, so import it here rather than at module level.
+        # This keeps importing this module cheap for callers that construct a CodaV2Client from an existing client.
+        import firebase_admin
+        from firebase_admin import credentials
+
+        # Serialise initialisation, so that concurrent callers can't race to initialise the same Firebase app.
+        with _init_client_lock:
+            client_key = (crypto_token_path, app_name)
+            if client_key in _firestore_clients:
+                log.debug(f"Reusing Firestore client for Firebase app {app_name}")
+                return cls(_firestore_clients[client_key])
+
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                log.debug("Creating default Firebase app")
+                firebase_admin.initialize_app()
+
+            cred = credentials.Certificate(crypto_token_path)
+            try:
+                app = firebase_admin.get_app(app_name)
+            except ValueError:
+                log.debug(f"Creating Firebase app {app_name}")
+                app = firebase_admin.initialize_app(cred, name=app_name)
+                _owned_firebase_apps[client_key] = app
+            else:
+                # Reuse the app if it was already created with the same credentials, for example by code outside this
+                # client or by an earlier call with a different path to the same credentials file. An app with other
+                # credentials would connect to the wrong project or as the wrong user, so refuse to reuse it.
+                if not (isinstance(app.credential, credentials.Certificate) and
+                        app.credential.project_id == cred.project_id and
+                        app.credential.service_account_email == cred.service_account_email):
+                    raise ValueError(f"Firebase app {app_name} already exists with credentials other than those in "
+                                     f"{crypto_token_path}")
+                log.debug(f"Reusing existing Firebase app {app_name}")
+
+            # Create the Firestore client here rather than with firebase_admin.firestore.client, which caches its
+            # client on the app. That way the client is only shared through `_firestore_clients`, and `close` can
+            # stop it from being handed out again.
+            client = firestore.Client(
+                project=app.project_id,
+                credentials=app.credential.get_credential(),
+                client_options=client_options
+            )
+
+            _firestore_clients[client_key] = client
+            return cls(client)
+
+    def close(self):
+        """
+        Stops any snapshot listeners started by this client, and releases the Firestore client and Firebase app that
+        `init_client` created for it.
+
+        Clients returned by `init_client` with the same credentials and app name share one Firestore client, so this
+        releases it for all of them, and they must not be used afterwards. The Firestore client's connections are
+        closed once it is no longer referenced. The next call to `init_client` creates a new Firestore client, and a
+        new Firebase app if `init_client` created the previous one.
+        """
+        import firebase_admin
+
+        self.stop_listening_to_messages_metrics()
+
+        with _init_client_lock:
+            for client_key, client in list(_firestore_clients.items()):
+                if client is not self._client:
+                    continue
+
+                del _firestore_clients[client_key]
+                app = _owned_firebase_apps.pop(client_key, None)
+                if app is not None:
+                    log.debug(f"Deleting Firebase app {app.name}")
+                    firebase_admin.delete_app(app)
 
     def transaction(self):
         """
@@ -55,6 +184,50 @@ class CodaV2Client:
         """
         return self._client.transaction()
 
+    @contextlib.contextmanager
+    def batched_writes(self):
+        """
+        Context manager which defers the commits of the segment code scheme, segment user id, and segment count writes
+        made without a transaction in the calling thread, so that the writes made in a loop are committed together when
+        the block exits, rather than one commit per call.
+
+        Writes are committed early in batches of `MAX_BATCH_WRITES` if there are too many to commit at once. If the
+        block raises an exception, the writes that haven't been committed yet are discarded.
+
+        Reads in the block don't see the block's own pending writes. `create_next_segment` therefore can't be called
+        without a transaction in the block, because it would create segments from a segment count that is out of date.
+
+        Usage:
+            with client.batched_writes():
+                for segment_id in segment_ids:
+                    client.set_segment_user_ids(segment_id, user_ids)
+        """
+        assert getattr(self._batched_writes_state, "batch", None) is None, "batched_writes blocks can't be nested"
+        self._batched_writes_state.batch = self._client.batch()
+        try:
+            yield
+            if len(self._batched_writes_state.batch) > 0:
+                self._batched_writes_state.batch.commit()
+        finally:
+            self._batched_writes_state.batch = None
+            # Writes made in the block were only committed now, so drop anything cached while they were pending.
+            self._code_schemes_checked_at.clear()
+            self._segment_cache.clear()
+            self._segment_count_cache.clear()
+
+    def _in_batched_writes(self):
+        return getattr(self._batched_writes_state, "batch", None) is not None
+
+    def _get_batched_writes_batch(self):
+        # Gets the batch of the current `batched_writes` block to add one write to, first committing the writes already
+        # in it if it is full. Callers making many writes should call this once per write, so that they can be split
+        # across batches.
+        batch = self._batched_writes_state.batch
+        if len(batch) >= self.MAX_BATCH_WRITES:
+            batch.commit()
+            batch = self._batched_writes_state.batch = self._client.batch()
+        return batch
+
     def get_dataset_ids(self):
         """
         Gets all the available dataset ids in Coda (For each segmented dataset, returns only the primary dataset id).
@@ -62,17 +235,23 @@ class CodaV2Client:
         :return: Ids of all the available datasets.
         :rtype: set of str
         """
-        segment_ids = self.get_segment_ids()
-        assert len(segment_ids) == len(set(segment_ids)), "Segment ids not unique"
+        # The segment ids and segment counts are independent collection reads, so fetch them concurrently.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            segment_ids_future = executor.submit(self.get_segment_ids)
+            segment_counts_future = executor.submit(self.get_segment_counts)
+            segment_ids = segment_ids_future.result()
+            segment_counts = segment_counts_future.result()
+
+        unique_segment_ids = set(segment_ids)
+        assert len(unique_segment_ids) == len(segment_ids), "Segment ids not unique"
 
-        dataset_ids = set(segment_ids)
-        for dataset_id in self.get_segmented_dataset_ids():
-            segment_count = self.get_segment_count(dataset_id)
-            if segment_count is not None and segment_count > 1:
-                for segment_index in range(2, segment_count + 1):
-                    dataset_ids.remove(self.id_for_segment(dataset_id, segment_index))
+        non_primary_segment_ids = {
+            self._suffixed_segment_id(dataset_id, segment_index)
+            for dataset_id, segment_count in segment_counts.items() if segment_count is not None
+            for segment_index in range(2, segment_count + 1)
+        }
 
-        return dataset_ids
+        return unique_segment_ids - non_primary_segment_ids
 
     def get_segment_ids(self):
         """
@@ -81,10 +260,9 @@ class CodaV2Client:
         :return: Ids of all segments.
         :rtype: list of str
         """
-        ids = []
-        for segment in self._client.collection("datasets").get():
-            ids.append(segment.id)
-        return ids
+        # Only the document ids are needed, so project out all the fields to avoid downloading every segment document.
+        segments = self._datasets_ref.select([firestore.FieldPath.document_id()]).stream()
+        return [segment.id for segment in segments]
 
     @staticmethod
     def id_for_segment(dataset_id, segment_index=None):
@@ -102,6 +280,18 @@ class CodaV2Client:
             return dataset_id
         return f"{dataset_id}_{segment_index}"
 
+    @staticmethod
+    def _suffixed_segment_id(dataset_id, segment_index):
+        # Id of segment `n` of a dataset, for n >= 2 only. Loops that only visit the non-primary segments use this to
+        # skip the primary-segment checks in `id_for_segment`.
+        return f"{dataset_id}_{segment_index}"
+
+    @staticmethod
+    def _segment_ids(dataset_id, segment_count):
+        # Ids of all the segments of a dataset, in segment order. Building the list once lets loops over the segments
+        # skip calling `id_for_segment` per segment.
+        return [dataset_id] + [f"{dataset_id}_{segment_index}" for segment_index in range(2, segment_count + 1)]
+
     def get_segmented_dataset_ids(self):
         """
         Gets segmented dataset ids
@@ -109,10 +299,42 @@ class CodaV2Client:
         :return: Ids of all datasets that are segmented
         :rtype: list of str
         """
-        segmented_dataset_ids = []
-        for doc in self._client.collection("segment_counts").get():
-            segmented_dataset_ids.append(doc.id)
-        return segmented_dataset_ids
+        # Reading the counts costs only one small field per document over an id-only scan, and refreshes the segment
+        # count cache for the datasets listed.
+        return list(self.get_segment_counts())
+
+    def get_segment_counts(self):
+        """
+        Gets the number of segments for every segmented dataset, by reading the whole `segment_counts` collection in
+        one request.
+
+        The fetched counts are also used to refresh the segment count cache.
+
+        :return: Dictionary of dataset id -> number of segments in that dataset.
+        :rtype: dict of str -> int
+        """
+        segment_counts = dict()
+        for doc in self._segment_counts_ref.select(["segment_count"]).stream():
+            segment_count = doc.get("segment_count")
+            segment_counts[doc.id] = segment_count
+            self._cache_segment_count(doc.id, segment_count)
+        return segment_counts
+
+    def _cache_segment_count(self, dataset_id, segment_count):
+        self._segment_count_cache[dataset_id] = (segment_count, time.monotonic())
+
+    def invalidate_segment_count(self, dataset_id):
+        """
+        Drops any cached segment count for a dataset, so that the next call to `get_segment_count` reads it from
+        Firestore.
+
+        Use this after another client may have created a new segment for the dataset.
+
+        :param dataset_id: Id of a dataset.
+        :type dataset_id: str
+        """
+        self._segment_count_cache.pop(dataset_id, None)
+        self._filled_segment_highest_seq_nos.pop(dataset_id, None)
 
     def get_dataset_segment_count_ref(self, dataset_id):
         """
@@ -123,23 +345,39 @@ class CodaV2Client:
         :return: A reference to a document in a Firestore database
         :rtype: google.cloud.firestore.DocumentReference
         """
-        return self._client.document(f"segment_counts/{dataset_id}")
+        return self._segment_counts_ref.document(dataset_id)
 
-    def get_segment_count(self, dataset_id, transaction=None):
+    def get_segment_count(self, dataset_id, transaction=None, use_cache=True):
         """
         Gets number of segments for a given dataset. If the dataset is not segmented, returns 1
 
+        Segment counts read outside of a transaction are cached for `SEGMENT_COUNT_CACHE_TTL_SECONDS`, because they
+        only change when a new segment is created.
+
         :param dataset_id: Id of a dataset
         :type dataset_id: str
-        :param transaction: Transaction to run this get in.
+        :param transaction: Transaction to run this get in. Transactional gets always read from Firestore.
         :type transaction: google.cloud.firestore.Transaction | None
+        :param use_cache: Whether to return a cached segment count if a fresh one is available. Defaults to True.
+        :type use_cache: bool, optional
         :return: Number of segments for a given dataset
         :rtype: int
         """
-        segment_count_doc = self.get_dataset_segment_count_ref(dataset_id).get(transaction=transaction).to_dict()
-        if segment_count_doc is None:
-            return 1
-        return segment_count_doc["segment_count"]
+        if transaction is None and use_cache and dataset_id in self._segment_count_cache:
+            segment_count, cached_at = self._segment_count_cache[dataset_id]
+            if time.monotonic() - cached_at < self.SEGMENT_COUNT_CACHE_TTL_SECONDS:
+                return segment_count
+
+        segment_count_snapshot = self.get_dataset_segment_count_ref(dataset_id).get(
+            transaction=transaction, retry=self.SEGMENT_READ_RETRY, timeout=self.SEGMENT_READ_TIMEOUT_SECONDS
+        )
+        if segment_count_snapshot.exists:
+            segment_count = segment_count_snapshot.get("segment_count")
+        else:
+            segment_count = 1
+
+        self._cache_segment_count(dataset_id, segment_count)
+        return segment_count
 
     def set_segment_count(self, dataset_id, segment_count, transaction=None): #TODO: Rename to set_dataset_segment_count
         """
@@ -150,10 +388,20 @@ class CodaV2Client:
         :param segment_count: Number of segment for a given dataset.
         :type segment_count: int
         """
-        if transaction is None:
+        if transaction is None and self._in_batched_writes():
+            # Add the update to the batch of the current `batched_writes` block. The block may not commit it, so drop
+            # the cached count rather than updating it.
+            self._get_batched_writes_batch().set(
+                self.get_dataset_segment_count_ref(dataset_id), {"segment_count": segment_count}
+            )
+            self.invalidate_segment_count(dataset_id)
+        elif transaction is None:
             self.get_dataset_segment_count_ref(dataset_id).set({"segment_count": segment_count})
+            self._cache_segment_count(dataset_id, segment_count)
         else:
             transaction.set(self.get_dataset_segment_count_ref(dataset_id), {"segment_count": segment_count})
+            # The transaction may not commit, so drop the cached count rather than updating it.
+            self.invalidate_segment_count(dataset_id)
 
     def create_next_segment(self, dataset_id, transaction=None):
         """
@@ -164,7 +412,14 @@ class CodaV2Client:
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
         """
-        segment_count = self.get_segment_count(dataset_id, transaction=transaction)
+        # A segment count written earlier in a `batched_writes` block isn't committed yet, so the read below wouldn't see
+        # it, and a second call for the same dataset would create the same segment again.
+        assert transaction is not None or not self._in_batched_writes(), \
+            "create_next_segment can't be called without a transaction inside a batched_writes block"
+
+        # Read the segment count from Firestore rather than the cache. Creating a segment from a stale count would
+        # overwrite a segment another client has already created, and lower the stored segment count.
+        segment_count = self.get_segment_count(dataset_id, transaction=transaction, use_cache=False)
         current_segment_id = self.id_for_segment(dataset_id, segment_count)
 
         next_segment_count = segment_count + 1
@@ -172,22 +427,30 @@ class CodaV2Client:
 
         log.debug(f"Creating next dataset segment with id {next_segment_id}")
 
-        code_schemes = self.get_all_code_schemes(current_segment_id, transaction=transaction)
-        user_ids = self.get_dataset_user_ids(current_segment_id, transaction=transaction)
+        # The code schemes and users are copied from the current last segment only. The segment count of that segment's
+        # id is always 1 (it is either the dataset id of an unsegmented dataset, or the id of a non-primary segment), so
+        # the consistency checks would only spend a read each to find that out. Skip them.
+        if transaction is None:
+            # The code schemes and users are independent reads, so fetch them concurrently.
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                code_schemes_future = executor.submit(
+                    self.get_all_code_schemes, current_segment_id, check_consistency=False
+                )
+                user_ids_future = executor.submit(
+                    self.get_dataset_user_ids, current_segment_id, check_consistency=False
+                )
+                code_schemes = code_schemes_future.result()
+                user_ids = user_ids_future.result()
+        else:
+            # Transactions can't be shared between threads, so read in sequence.
+            code_schemes = self.get_all_code_schemes(current_segment_id, transaction=transaction, check_consistency=False)
+            user_ids = self.get_dataset_user_ids(current_segment_id, transaction=transaction, check_consistency=False)
 
         self.add_and_update_segment_code_schemes(next_segment_id, code_schemes, transaction=transaction)
         if user_ids is not None:
             self.set_segment_user_ids(next_segment_id, user_ids, transaction=transaction)
         self.set_segment_count(dataset_id, next_segment_count, transaction=transaction)
 
-        if transaction is None:
-            for x in range(0, 10):
-                if self.get_segment_count(dataset_id) == next_segment_count:
-                    return
-                log.debug("New segment count not yet committed, waiting 1s before retrying")
-                time.sleep(1)
-            assert False, "Server segment count did not update to the newest count fast enough"
-
     def get_message_ref(self, segment_id, message_id):
         """
         Gets Firestore database reference to a message.
@@ -199,7 +462,7 @@ class CodaV2Client:
         :return: A reference to a document in a Firestore database
         :rtype: google.cloud.firestore.DocumentReference
         """
-        return self._client.document(f"datasets/{segment_id}/messages/{message_id}")
+        return self.get_messages_ref(segment_id).document(message_id)
 
     def get_messages_ref(self, segment_id):
         """
@@ -210,7 +473,7 @@ class CodaV2Client:
         :return: A reference to collection `messages` in Firestore database
         :rtype: google.cloud.firestore.CollectionReference
         """
-        return self._client.collection(f"datasets/{segment_id}/messages")
+        return self.get_segment_ref(segment_id).collection("messages")
 
     def get_segment_message(self, segment_id, message_id, transaction=None):
         """
@@ -225,12 +488,40 @@ class CodaV2Client:
         :return: A message from a segment.
         :rtype: core_data_modules.data_models.message.Message | None
         """
-        message_snapshot = self.get_message_ref(segment_id, message_id).get(transaction=transaction)
+        message_snapshot = self.get_message_ref(segment_id, message_id).get(
+            transaction=transaction, retry=self.SEGMENT_READ_RETRY, timeout=self.SEGMENT_READ_TIMEOUT_SECONDS
+        )
         if message_snapshot.exists:
             return Message.from_firebase_map(message_snapshot.to_dict())
         return None
 
-    def update_segment_message(self, segment_id, message, transaction):
+    def get_segment_messages_by_id(self, segment_id, message_ids, transaction=None):
+        """
+        Gets many messages from a segment by id, in a single batched request.
+
+        :param segment_id: Id of a segment.
+        :type segment_id: str
+        :param message_ids: Ids of the messages to get.
+        :type message_ids: iterable of str
+        :param transaction: Transaction to run this get in.
+        :type transaction: google.cloud.firestore.Transaction | None
+        :return: Dictionary of message id -> message, or None if the message was not found in this segment.
+        :rtype: dict of str -> core_data_modules.data_models.message.Message | None
+        """
+        messages = {message_id: None for message_id in message_ids}
+        if len(messages) == 0:
+            return messages
+
+        # This can fetch any number of messages, so keep Firestore's default retry and timeout rather than the short
+        # per-attempt timeout used for segment probes.
+        message_refs = [self.get_message_ref(segment_id, message_id) for message_id in messages]
+        for message_snapshot in self._client.get_all(message_refs, transaction=transaction):
+            if message_snapshot.exists:
+                messages[message_snapshot.id] = Message.from_firebase_map(message_snapshot.to_dict())
+
+        return messages
+
+    def update_segment_message(self, segment_id, message, transaction, code_schemes_cache=None):
         """
         Updates an existing message in a segment.
 
@@ -240,41 +531,78 @@ class CodaV2Client:
         :type message: core_data_modules.data_models.message.Message
         :param transaction: Transaction to run this set in.
         :type transaction: google.cloud.firestore.Transaction
+        :param code_schemes_cache: If specified, the segment's code schemes are taken from this dictionary if present,
+                                   otherwise they are downloaded and added to it. Callers updating many messages can
+                                   pass the same dictionary to each call so that each segment's code schemes are only
+                                   downloaded once. Only share a dictionary between calls made while the code schemes
+                                   are not being changed. Defaults to None.
+        :type code_schemes_cache: dict of str -> list of core_data_modules.data_models.code_scheme.CodeScheme | None
         """
         # Check the message already exists in this segment.
         old_message = self.get_segment_message(segment_id, message.message_id, transaction=transaction)
         if old_message is None:
             raise ValueError(f"Message {message.message_id} not found in segment {segment_id}")
 
-        # Get the segment's current metrics.
-        segment_metrics = self.get_segment_messages_metrics(segment_id, transaction=transaction)
-        segment_code_schemes = self.get_all_code_schemes(segment_id, transaction=transaction)
+        if code_schemes_cache is not None and segment_id in code_schemes_cache:
+            segment_code_schemes = code_schemes_cache[segment_id]
+        else:
+            segment_code_schemes = self.get_all_code_schemes(segment_id, transaction=transaction)
+            if code_schemes_cache is not None:
+                code_schemes_cache[segment_id] = segment_code_schemes
 
         # Update the message.
         transaction.set(self.get_message_ref(segment_id, message.message_id), message.to_firebase_map())
 
-        # Update the segment's metrics.
-        segment_metrics -= CodaV2Client.compute_message_metrics(old_message, segment_code_schemes)
-        segment_metrics += CodaV2Client.compute_message_metrics(message, segment_code_schemes)
-        self.set_segment_messages_metrics(segment_id, segment_metrics, transaction=transaction)
-
-    def update_dataset_message(self, dataset_id, message, transaction):
-        segment_id = self.get_segment_id_for_message_id(dataset_id, message.message_id, transaction=transaction)
+        # Update the segment's metrics by the change this update makes to them. Applying the change with server-side
+        # increments means the segment's current metrics don't need to be read first.
+        codes_lut = CodaV2Client._build_codes_lut(segment_code_schemes)
+        metrics_delta = CodaV2Client._compute_message_metrics_with_codes_lut(message, codes_lut) - \
+            CodaV2Client._compute_message_metrics_with_codes_lut(old_message, codes_lut)
+        metrics_increments = {
+            field: firestore.Increment(delta) for field, delta in metrics_delta.to_firebase_map().items() if delta != 0
+        }
+        if len(metrics_increments) > 0:
+            transaction.update(self.get_segment_messages_metrics_ref(segment_id), metrics_increments)
+
+    def update_dataset_message(self, dataset_id, message, transaction, code_schemes_cache=None):
+        # Search every segment that currently exists, so that a message in a segment created since the segment count
+        # was cached is updated rather than re-added.
+        segment_id = self.get_segment_id_for_message_id(
+            dataset_id, message.message_id, transaction=transaction, use_cache=False
+        )
         if segment_id is None:
             self.add_message_to_dataset(dataset_id, message)
             return
 
-        self.update_segment_message(segment_id, message, transaction=transaction)
+        self.update_segment_message(segment_id, message, transaction=transaction, code_schemes_cache=code_schemes_cache)
 
-    def get_segment_id_for_message_id(self, dataset_id, message_id, transaction):
-        segment_count = self.get_segment_count(dataset_id, transaction=transaction)
-        for segment_index in range(1, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            message = self.get_segment_message(segment_id, message_id, transaction=transaction)
-            if message is not None:
-                return segment_id
+    def get_segment_id_for_message_id(self, dataset_id, message_id, transaction, use_cache=False):
+        """
+        Gets the id of the segment of a dataset that contains a message. If the message is not found, returns None.
 
-        return None
+        All the segments are searched in a single batched request.
+
+        :param dataset_id: Id of a dataset.
+        :type dataset_id: str
+        :param message_id: Id of a message.
+        :type message_id: str
+        :param transaction: Transaction to run this get in.
+        :type transaction: google.cloud.firestore.Transaction | None
+        :param use_cache: Whether the dataset's segment count may be read from the segment count cache (see
+                          `get_segment_count`). If True, a message in a segment created by another client within the
+                          cache's TTL may not be found. Defaults to False.
+        :type use_cache: bool, optional
+        :return: Id of the segment that contains the message.
+        :rtype: str | None
+        """
+        # Only the message's location matters here, so don't pay to parse it into a Message.
+        segment_count = self.get_segment_count(dataset_id, transaction=transaction, use_cache=use_cache)
+        message_snapshot = self._get_dataset_message_snapshot(
+            dataset_id, message_id, transaction=transaction, segment_count=segment_count
+        )
+        if message_snapshot is None:
+            return None
+        return message_snapshot.reference.parent.parent.id
 
     def get_segment_messages(self, segment_id, last_updated_after=None, last_updated_before=None, transaction=None):
         """
@@ -297,16 +625,38 @@ class CodaV2Client:
         :return: Messages in this segment, filtered by 'LastUpdated' timestamp if requested.
         :rtype: list of core_data_modules.data_models.message.Message
         """
+        return list(self.iter_segment_messages(segment_id, last_updated_after, last_updated_before, transaction))
+
+    def iter_segment_messages(self, segment_id, last_updated_after=None, last_updated_before=None, transaction=None):
+        """
+        Downloads messages from the requested segment, yielding each message as it arrives rather than collecting the
+        whole segment in memory first.
+
+        Filters in the same way as `get_segment_messages`.
+
+        :param segment_id: Id of segment to download messages from.
+        :type segment_id: str
+        :param last_updated_after: If specified, filters the downloaded messages to only include messages with a LastUpdated
+                                   field and where the LastUpdated field is later than last_updated_after. Defaults to None.
+        :type last_updated_after: datetime, optional
+        :param last_updated_before: If specified, filters the downloaded messages to only include messages with a LastUpdated
+                                    field and where the LastUpdated field is earlier than, or the same time as,
+                                    last_updated_before. Defaults to None
+        :type last_updated_before: datetime, optional
+        :param transaction: Transaction to run this get in.
+        :type transaction: google.cloud.firestore.Transaction
+        :return: Messages in this segment, filtered by 'LastUpdated' timestamp if requested.
+        :rtype: iterator of core_data_modules.data_models.message.Message
+        """
         messages_ref = self.get_messages_ref(segment_id)
         if last_updated_after is not None:
             messages_ref = messages_ref.where("LastUpdated", ">", last_updated_after)
         if last_updated_before is not None:
             messages_ref = messages_ref.where("LastUpdated", "<=", last_updated_before)
-        raw_messages = [message.to_dict() for message in messages_ref.get(transaction=transaction)]
-
-        return [Message.from_firebase_map(message) for message in raw_messages]
+        for message in messages_ref.stream(transaction=transaction):
+            yield Message.from_firebase_map(message.to_dict())
 
-    def get_dataset_message(self, dataset_id, message_id, transaction=None):
+    def get_dataset_message(self, dataset_id, message_id, transaction=None, segment_count=None):
         """
         Gets a message from a dataset by id. If the message is not found, returns None.
 
@@ -316,20 +666,90 @@ class CodaV2Client:
         :type message_id: str
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
+        :param segment_count: Number of segments in the dataset, if already known by the caller. If None, the segment
+                              count is read from Firestore, bypassing the segment count cache. Defaults to None.
+        :type segment_count: int | None, optional
         :return: A message from a dataset.
         :rtype: core_data_modules.data_models.message.Message | None
         """
-        segment_count = self.get_segment_count(dataset_id)
-        for segment_index in range(1, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            message = self.get_segment_message(segment_id, message_id, transaction=transaction)
-            if message is not None:
-                log.debug(f"Message found in segment {segment_id}")
-                return message
+        message_snapshot = self._get_dataset_message_snapshot(
+            dataset_id, message_id, transaction=transaction, segment_count=segment_count
+        )
+        if message_snapshot is None:
+            return None
+        return Message.from_firebase_map(message_snapshot.to_dict())
+
+    def _get_dataset_message_snapshot(self, dataset_id, message_id, transaction=None, segment_count=None):
+        # Searches every segment of a dataset for a message in a single batched request, returning the snapshot of the
+        # message document if found, otherwise None.
+        if segment_count is None:
+            # Read the count from Firestore rather than the cache, so that a message in a segment another client has
+            # just created isn't reported as missing.
+            segment_count = self.get_segment_count(dataset_id, transaction=transaction, use_cache=False)
+        message_refs = [
+            self.get_message_ref(segment_id, message_id) for segment_id in self._segment_ids(dataset_id, segment_count)
+        ]
+
+        # Fetch the candidate message document from every segment in a single batched request.
+        # get_all streams its results, so a timeout would be a deadline on the whole stream, and a DeadlineExceeded
+        # raised while iterating wouldn't be retried. Keep Firestore's default retry and timeout here instead of the
+        # short per-attempt timeout used for single-document segment probes.
+        message_snapshots = self._client.get_all(message_refs, transaction=transaction)
+        found_snapshot = None
+        for message_snapshot in message_snapshots:
+            if message_snapshot.exists:
+                found_snapshot = message_snapshot
+                break
+
+        # Log once per lookup rather than once per segment searched.
+        if found_snapshot is None:
+            log.debug(f"Message {message_id} not found in any of the {segment_count} segment(s) of dataset {dataset_id}")
+            return None
+
+        log.debug(f"Message {message_id} found in segment {found_snapshot.reference.parent.parent.id} "
+                  f"({segment_count} segment(s) searched)")
+        return found_snapshot
+
+    def get_messages_by_id(self, dataset_message_ids):
+        """
+        Gets many messages, possibly from different datasets, by id.
 
-        return None
+        All the segment counts are read in one request, then every segment that could contain each message is searched
+        in a single batched request.
+
+        :param dataset_message_ids: (dataset id, message id) pairs of the messages to get.
+        :type dataset_message_ids: iterable of (str, str)
+        :return: Dictionary of (dataset id, message id) -> message, or None if the message was not found.
+        :rtype: dict of (str, str) -> core_data_modules.data_models.message.Message | None
+        """
+        segment_counts = self.get_segment_counts()
+
+        messages = dict()  # of (dataset id, message id) -> Message | None
+        message_ref_owners = dict()  # of message document path -> (dataset id, message id)
+        message_refs = []
+        for dataset_id, message_id in dataset_message_ids:
+            messages[(dataset_id, message_id)] = None
+            # Datasets without a segment count, or with a stored count of None, have a single segment.
+            segment_count = segment_counts.get(dataset_id)
+            if segment_count is None:
+                segment_count = 1
+            for segment_id in self._segment_ids(dataset_id, segment_count):
+                message_ref = self.get_message_ref(segment_id, message_id)
+                message_refs.append(message_ref)
+                message_ref_owners[message_ref.path] = (dataset_id, message_id)
+
+        if len(message_refs) == 0:
+            return messages
 
-    def get_dataset_messages(self, dataset_id, last_updated_after=None):
+        # get_all doesn't return snapshots in the order requested, so match them back up by document path.
+        for message_snapshot in self._client.get_all(message_refs):
+            if message_snapshot.exists:
+                messages[message_ref_owners[message_snapshot.reference.path]] = \
+                    Message.from_firebase_map(message_snapshot.to_dict())
+
+        return messages
+
+    def get_dataset_messages(self, dataset_id, last_updated_after=None, consistent_snapshot=False):
         """
         Downloads messages from the requested dataset, optionally filtering by when the messages were last updated.
 
@@ -341,62 +761,135 @@ class CodaV2Client:
         :param last_updated_after: If specified, filters the downloaded messages to only include messages with a LastUpdated
                                    field and where the LastUpdated field is later than last_updated_after. Defaults to None.
         :type last_updated_after: datetime, optional
+        :param consistent_snapshot: If True, downloads all the segments in a single read-only transaction, so that the
+                                    messages returned are a consistent snapshot of the dataset and no catch-up queries
+                                    are needed. The segments are then downloaded one at a time rather than
+                                    concurrently, and the download must finish within Firestore's transaction time
+                                    limit. Defaults to False.
+        :type consistent_snapshot: bool, optional
         :return: Messages in this dataset, filtered by 'LastUpdated' timestamp if requested.
         :rtype: list of core_data_modules.data_models.message.Message
         """
-        segment_count = self.get_segment_count(dataset_id)
-        if segment_count == 1:
-            return self.get_segment_messages(dataset_id, last_updated_after)
-        else:
-            # Get the messages for each segment
-            messages_by_segment = dict()  # of segment id -> list of message
-            for segment_index in range(1, segment_count + 1):
-                segment_id = self.id_for_segment(dataset_id, segment_index)
-                messages_by_segment[segment_id] = self.get_segment_messages(segment_id, last_updated_after)
-
-            # Search the fetched segments for the most and least recently updated timestamps in all the segments downloaded
-            # above.
-            dataset_first_updated = None
-            dataset_last_updated = None
-            for segment_messages in messages_by_segment.values():
-                for msg in segment_messages:
-                    if msg.last_updated is not None:
-                        if dataset_last_updated is None or msg.last_updated > dataset_last_updated:
-                            dataset_last_updated = msg.last_updated
-                        if dataset_first_updated is None or msg.last_updated < dataset_first_updated:
-                            dataset_first_updated = msg.last_updated
-
-            # Check all the segments for any messages between the latest one we fetched above and the most recently updated
-            # message seen in any segment. If we didn't fetch any new messages for a segment, use the oldest timestamp
-            # across all segments (dataset_first_updated) instead. This is to ensure we don't miss any messages that were
-            # being labelled while we were pulling the separate segments, and is needed to maintain the consistency
-            # guarantees we need for incremental fetch.
-            for segment_id, segment_messages in messages_by_segment.items():
-                segment_last_updated = None
-                for msg in segment_messages:
-                    if msg.last_updated is not None:
-                        if segment_last_updated is None or msg.last_updated > segment_last_updated:
-                            segment_last_updated = msg.last_updated
+        if consistent_snapshot:
+            return self._get_dataset_messages_in_snapshot(dataset_id, last_updated_after)
 
-                if segment_last_updated is None:
-                    segment_last_updated = dataset_first_updated
+        # De-duplicate the downloaded messages by message id. iter_dataset_messages yields later copies of a message
+        # after earlier ones, so the most recent copy of each message is kept.
+        messages = dict()  # of message id -> Message
+        for message in self.iter_dataset_messages(dataset_id, last_updated_after):
+            messages[message.message_id] = message
 
-                if segment_last_updated is not None:
-                    updated_segment_messages = self.get_segment_messages(segment_id, last_updated_after=segment_last_updated, last_updated_before=dataset_last_updated)  # nopep8
-                    messages_by_segment[segment_id].extend(updated_segment_messages)
+        return list(messages.values())
+
+    def _get_dataset_messages_in_snapshot(self, dataset_id, last_updated_after=None):
+        # Downloads messages from the requested dataset in a read-only transaction. Read-only transactions don't take
+        # any locks, and all their reads see the same snapshot of the database, so each message is read exactly once.
+        @firestore.transactional
+        def get_in_transaction(transaction):
+            segment_count = self.get_segment_count(dataset_id, transaction=transaction)
 
-            # Combine all the messages downloaded from each segment.
+            # Transactions can't be shared between threads, so read the segments in sequence.
             messages = []
-            for segment_messages in messages_by_segment.values():
-                messages.extend(segment_messages)
+            for segment_id in self._segment_ids(dataset_id, segment_count):
+                messages.extend(self.get_segment_messages(segment_id, last_updated_after, transaction=transaction))
+            return messages
 
-            # Check that there are no duplicate message ids.
-            seen_message_ids = set()
-            for message in messages:
-                assert message.message_id not in seen_message_ids, "Duplicate message found"
-                seen_message_ids.add(message.message_id)
+        return get_in_transaction(self._client.transaction(read_only=True))
 
-            return messages
+    def iter_dataset_messages(self, dataset_id, last_updated_after=None):
+        """
+        Downloads messages from the requested dataset, yielding the messages from each segment as soon as that segment
+        has been downloaded rather than collecting the whole dataset in memory first. At most about
+        `MAX_SEGMENT_READ_WORKERS` segments are downloaded ahead of the one being yielded, so the memory used is bounded
+        by a few segments however slowly the messages are consumed.
+
+        Filters in the same way as `get_dataset_messages`. Unlike `get_dataset_messages`, a message that was updated
+        while the dataset was being downloaded may be yielded more than once. Later copies of a message are always
+        more recent than earlier ones.
+
+        :param dataset_id: Id of dataset to download messages from.
+        :type dataset_id: str
+        :param last_updated_after: If specified, filters the downloaded messages to only include messages with a LastUpdated
+                                   field and where the LastUpdated field is later than last_updated_after. Defaults to None.
+        :type last_updated_after: datetime, optional
+        :return: Messages in this dataset, filtered by 'LastUpdated' timestamp if requested.
+        :rtype: iterator of core_data_modules.data_models.message.Message
+        """
+        # Always read the latest segment count here. Missing a newly created segment would cause its messages to be
+        # skipped by incremental fetches that use the returned messages to choose the next last_updated_after.
+        segment_count = self.get_segment_count(dataset_id, use_cache=False)
+        if segment_count == 1:
+            yield from self.get_segment_messages(dataset_id, last_updated_after)
+            return
+
+        segment_ids = self._segment_ids(dataset_id, segment_count)
+        max_workers = min(segment_count, self.MAX_SEGMENT_READ_WORKERS)
+
+        # Get the messages for each segment, downloading the segments concurrently. While yielding each segment's
+        # messages, search them in a single pass for the most recently updated timestamp in that segment, and for the
+        # most and least recently updated timestamps in all the segments downloaded.
+        last_updated_by_segment = dict()  # of segment id -> datetime | None
+        dataset_first_updated = None
+        dataset_last_updated = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            segment_messages_list = self._map_with_bounded_lookahead(
+                executor, lambda segment_id: self.get_segment_messages(segment_id, last_updated_after), segment_ids,
+                max_workers
+            )
+            for segment_id, segment_messages in zip(segment_ids, segment_messages_list):
+                segment_last_updated = None
+                for msg in segment_messages:
+                    last_updated = msg.last_updated
+                    if last_updated is None:
+                        continue
+                    if segment_last_updated is None or last_updated > segment_last_updated:
+                        segment_last_updated = last_updated
+                    if dataset_first_updated is None or last_updated < dataset_first_updated:
+                        dataset_first_updated = last_updated
+                last_updated_by_segment[segment_id] = segment_last_updated
+
+                if segment_last_updated is not None and \
+                        (dataset_last_updated is None or segment_last_updated > dataset_last_updated):
+                    dataset_last_updated = segment_last_updated
+
+                yield from segment_messages
+
+        # Check all the segments for any messages between the latest one we fetched above and the most recently updated
+        # message seen in any segment. If we didn't fetch any new messages for a segment, use the oldest timestamp
+        # across all segments (dataset_first_updated) instead. This is to ensure we don't miss any messages that were
+        # being labelled while we were pulling the separate segments, and is needed to maintain the consistency
+        # guarantees we need for incremental fetch.
+        catch_up_ranges = dict()  # of segment id -> last_updated_after to check the segment from
+        for segment_id, segment_last_updated in last_updated_by_segment.items():
+            if segment_last_updated is None:
+                segment_last_updated = dataset_first_updated
+
+            # If this segment already contains the most recently updated message, the catch-up range is empty.
+            if segment_last_updated is not None and segment_last_updated != dataset_last_updated:
+                catch_up_ranges[segment_id] = segment_last_updated
+
+        # Run the catch-up queries for all the segments concurrently.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            updated_segment_messages_list = self._map_with_bounded_lookahead(
+                executor,
+                lambda catch_up_range: self.get_segment_messages(catch_up_range[0], last_updated_after=catch_up_range[1], last_updated_before=dataset_last_updated),  # nopep8
+                catch_up_ranges.items(), max_workers
+            )
+            for updated_segment_messages in updated_segment_messages_list:
+                yield from updated_segment_messages
+
+    @staticmethod
+    def _map_with_bounded_lookahead(executor, fn, items, max_lookahead):
+        # Like `executor.map`, but only submits calls for up to `max_lookahead` items ahead of the result being
+        # consumed, rather than for every item up front. Results that haven't been consumed yet therefore can't build
+        # up in memory, and if the caller stops early, no more than `max_lookahead` calls are left to finish.
+        items = iter(items)
+        futures = collections.deque(executor.submit(fn, item) for item in itertools.islice(items, max_lookahead))
+        while len(futures) > 0:
+            result = futures.popleft().result()
+            for item in itertools.islice(items, 1):
+                futures.append(executor.submit(fn, item))
+            yield result
 
     def get_code_schemes_ref(self, segment_id):
         """
@@ -407,42 +900,60 @@ class CodaV2Client:
         :return: A reference to collection `code_schemes` in Firestore database
         :rtype: google.cloud.firestore.CollectionReference
         """
-        return self._client.collection(f"datasets/{segment_id}/code_schemes")
+        return self.get_segment_ref(segment_id).collection("code_schemes")
 
-    def ensure_code_schemes_consistent(self, dataset_id, transaction=None):
+    def ensure_code_schemes_consistent(self, dataset_id, transaction=None, segment_count=None):
         """
         Checks that the code schemes are the same in all segments
 
+        A dataset that passed this check is not checked again for `CODE_SCHEMES_CONSISTENCY_CHECK_TTL_SECONDS`, unless
+        its code schemes are written by this client in the meantime.
+
         :param dataset_id: Id of a dataset.
         :type dataset_id: str
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
-        """
-        segment_count = self.get_segment_count(dataset_id, transaction=transaction)
-        if segment_count == 1:
-            return
-
-        first_segment_schemes = []
-        for code_scheme in self.get_code_schemes_ref(dataset_id).get():
-            first_segment_schemes.append(CodeScheme.from_firebase_map(code_scheme.to_dict()))
+        :param segment_count: Number of segments in the dataset, if already known by the caller. If None, the segment
+                              count is read from Firestore, bypassing the segment count cache. Defaults to None.
+        :type segment_count: int | None, optional
+        """
+        self._check_code_schemes_consistent(dataset_id, transaction=transaction, segment_count=segment_count)
+
+    def _check_code_schemes_consistent(self, dataset_id, transaction=None, segment_count=None):
+        # Implements `ensure_code_schemes_consistent`. If the segments' code schemes were downloaded to check them,
+        # returns the first segment's raw code scheme documents, as a dict of scheme id -> document dict, so that
+        # callers which also need the schemes don't have to download them again. Otherwise returns None.
+        checked_at = self._code_schemes_checked_at.get(dataset_id)
+        if checked_at is not None and time.monotonic() - checked_at < self.CODE_SCHEMES_CONSISTENCY_CHECK_TTL_SECONDS:
+            return None
 
-        for segment_index in range(2, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
+        if segment_count is None:
+            # Read the count from Firestore rather than the cache, so that the newest segment isn't skipped.
+            segment_count = self.get_segment_count(dataset_id, transaction=transaction, use_cache=False)
+        if segment_count == 1:
+            return None
 
-            current_segment_schemes = []
-            for code_scheme in self.get_code_schemes_ref(segment_id).get():
-                current_segment_schemes.append(CodeScheme.from_firebase_map(code_scheme.to_dict()))
+        # Download the raw code scheme documents of every segment concurrently, keyed by scheme id. The raw documents
+        # are compared directly, so there's no need to parse them into CodeSchemes or sort them.
+        segment_ids = self._segment_ids(dataset_id, segment_count)
+        with ThreadPoolExecutor(max_workers=min(segment_count, self.MAX_SEGMENT_READ_WORKERS)) as executor:
+            schemes_by_segment = executor.map(
+                lambda segment_id: {doc.id: doc.to_dict() for doc in self.get_code_schemes_ref(segment_id).stream()},
+                segment_ids
+            )
+            first_segment_schemes = next(schemes_by_segment)
 
-            assert len(first_segment_schemes) == len(current_segment_schemes), \
-                f"Segment {segment_id} has a different number of schemes to the first segment {dataset_id}"
+            for segment_id, current_segment_schemes in zip(segment_ids[1:], schemes_by_segment):
+                assert len(first_segment_schemes) == len(current_segment_schemes), \
+                    f"Segment {segment_id} has a different number of schemes to the first segment {dataset_id}"
 
-            first_segment_schemes.sort(key=lambda s: s.scheme_id)
-            current_segment_schemes.sort(key=lambda s: s.scheme_id)
+                assert first_segment_schemes == current_segment_schemes, \
+                    f"Segment {segment_id} has different schemes to the first segment {dataset_id}"
 
-            for x, y in zip(first_segment_schemes, current_segment_schemes):
-                assert x == y, f"Segment {segment_id} has different schemes to the first segment {dataset_id}"
+        self._code_schemes_checked_at[dataset_id] = time.monotonic()
+        return first_segment_schemes
 
-    def get_all_code_schemes(self, dataset_id, transaction=None):
+    def get_all_code_schemes(self, dataset_id, transaction=None, check_consistency=True, segment_count=None):
         """
         Gets all code schemes for a given dataset
 
@@ -450,10 +961,24 @@ class CodaV2Client:
         :type dataset_id: str
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
+        :param check_consistency: Whether to check that the code schemes are the same in all the dataset's segments
+                                  (see `ensure_code_schemes_consistent`). Defaults to True.
+        :type check_consistency: bool, optional
+        :param segment_count: Number of segments in the dataset, if already known by the caller. Passed on to
+                              `ensure_code_schemes_consistent` so that it doesn't need to read it again. Defaults to None.
+        :type segment_count: int | None, optional
         :return: Code schemes in this dataset
         :rtype: list of core_data_modules.data_models.code_scheme.CodeScheme
         """
-        self.ensure_code_schemes_consistent(dataset_id, transaction=transaction)
+        if check_consistency:
+            first_segment_schemes = self._check_code_schemes_consistent(
+                dataset_id, transaction=transaction, segment_count=segment_count
+            )
+
+            # If the check downloaded the schemes, use them rather than downloading them again. The check doesn't read
+            # in the transaction, so transactional callers still read the schemes below.
+            if first_segment_schemes is not None and transaction is None:
+                return [CodeScheme.from_firebase_map(scheme) for scheme in first_segment_schemes.values()]
 
         code_schemes = []
         for doc in self.get_code_schemes_ref(dataset_id).get(transaction=transaction):
@@ -471,7 +996,7 @@ class CodaV2Client:
         :return: A reference to a document in a Firestore database.
         :rtype: google.cloud.firestore.DocumentReference
         """
-        return self._client.document(f"datasets/{segment_id}/code_schemes/{scheme_id}")
+        return self.get_code_schemes_ref(segment_id).document(scheme_id)
 
     def set_dataset_code_scheme(self, dataset_id, code_scheme):
         """
@@ -482,17 +1007,7 @@ class CodaV2Client:
         :param code_scheme: Code scheme to be set.
         :type code_scheme: core_data_modules.data_models.code_scheme.CodeScheme
         """
-        scheme_id = code_scheme.scheme_id
-        segment_count = self.get_segment_count(dataset_id)
-
-        batch = self._client.batch()
-
-        for segment_index in range(1, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            batch.set(self.get_segment_code_scheme_ref(segment_id, scheme_id), code_scheme.to_firebase_map())
-
-        batch.commit()
-        log.debug(f"Wrote scheme: {scheme_id}")
+        self.add_and_update_dataset_code_schemes(dataset_id, [code_scheme])
 
     def set_segment_code_scheme(self, segment_id, code_scheme, transaction=None):
         """
@@ -506,7 +1021,11 @@ class CodaV2Client:
         :type transaction: google.cloud.firestore.Transaction | None
         """
         scheme_id = code_scheme.scheme_id
-        if transaction is None:
+        if transaction is None and self._in_batched_writes():
+            # Add the update to the batch of the current `batched_writes` block, which commits it later.
+            transaction = self._get_batched_writes_batch()
+            commit_before_returning = False
+        elif transaction is None:
             # If no transaction was given, run all the updates in a new batched-write transaction and flag that
             # this transaction needs to be committed before returning from this function.
             transaction = self._client.batch()
@@ -519,6 +1038,10 @@ class CodaV2Client:
         if commit_before_returning:
             transaction.commit()
 
+        # Writing to a single segment may make its dataset's segments inconsistent. We don't know which dataset this
+        # segment belongs to, so re-check every dataset next time.
+        self._code_schemes_checked_at.clear()
+
         log.debug(f"Wrote scheme: {scheme_id}")
 
     def add_and_update_dataset_code_schemes(self, dataset_id, code_schemes):
@@ -530,8 +1053,25 @@ class CodaV2Client:
         :param code_schemes: Code schemes to be added or updated.
         :type code_schemes: list of core_data_modules.data_models.code_scheme.CodeScheme
         """
+        # Read the segment count from Firestore rather than the cache, because the schemes must be written to every
+        # segment for the segments to stay consistent.
+        segment_count = self.get_segment_count(dataset_id, use_cache=False)
+
+        # Write every scheme to every segment in a single atomic batch where possible, so that all the segments are
+        # updated together. If there are more writes than fit in one batch, write them in as few batches as possible.
+        code_scheme_maps = [(code_scheme.scheme_id, code_scheme.to_firebase_map()) for code_scheme in code_schemes]
+        batch = self._client.batch()
+        for segment_id in self._segment_ids(dataset_id, segment_count):
+            for scheme_id, code_scheme_map in code_scheme_maps:
+                if len(batch) == self.MAX_BATCH_WRITES:
+                    batch.commit()
+                    batch = self._client.batch()
+                batch.set(self.get_segment_code_scheme_ref(segment_id, scheme_id), code_scheme_map)
+        batch.commit()
+        self._code_schemes_checked_at.pop(dataset_id, None)
+
         for code_scheme in code_schemes:
-            self.set_dataset_code_scheme(dataset_id, code_scheme)
+            log.debug(f"Wrote scheme: {code_scheme.scheme_id}")
 
     def add_and_update_segment_code_schemes(self, segment_id, code_schemes, transaction=None):
         """
@@ -544,8 +1084,36 @@ class CodaV2Client:
         :param transaction: Transaction to run this in or None.
         :type transaction: google.cloud.firestore.Transaction | None
         """
+        if transaction is None and self._in_batched_writes():
+            # Add the updates to the batch of the current `batched_writes` block, which commits them later. Get the
+            # batch once per scheme, so that more schemes than fit in one batch are split across batches.
+            for code_scheme in code_schemes:
+                self._get_batched_writes_batch().set(
+                    self.get_segment_code_scheme_ref(segment_id, code_scheme.scheme_id), code_scheme.to_firebase_map()
+                )
+        else:
+            if transaction is None:
+                # If no transaction was given, write all the schemes in a single new batched-write transaction and flag
+                # that this transaction needs to be committed before returning from this function.
+                transaction = self._client.batch()
+                commit_before_returning = True
+            else:
+                commit_before_returning = False
+
+            for code_scheme in code_schemes:
+                transaction.set(
+                    self.get_segment_code_scheme_ref(segment_id, code_scheme.scheme_id), code_scheme.to_firebase_map()
+                )
+
+            if commit_before_returning:
+                transaction.commit()
+
+        # Writing to a single segment may make its dataset's segments inconsistent. We don't know which dataset this
+        # segment belongs to, so re-check every dataset next time.
+        self._code_schemes_checked_at.clear()
+
         for code_scheme in code_schemes:
-            self.set_segment_code_scheme(segment_id, code_scheme, transaction=transaction)
+            log.debug(f"Wrote scheme: {code_scheme.scheme_id}")
 
     def get_segment_messages_metrics_ref(self, segment_id):
         """
@@ -556,9 +1124,9 @@ class CodaV2Client:
         :return: A reference to messages metrics document in Firestore database
         :rtype: google.cloud.firestore.DocumentReference
         """
-        return self._client.document(f"datasets/{segment_id}/metrics/messages")
+        return self.get_segment_ref(segment_id).collection("metrics").document("messages")
 
-    def get_segment_messages_metrics(self, segment_id, transaction=None):
+    def get_segment_messages_metrics(self, segment_id, transaction=None, use_listener=False):
         """
         Gets messages metrics for a given segment
 
@@ -566,13 +1134,63 @@ class CodaV2Client:
         :type segment_id: str
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
+        :param use_listener: If True and not in a transaction, starts a snapshot listener on the segment's metrics the
+                             first time they are requested, and returns the latest metrics seen by that listener on
+                             later calls, without reading from Firestore. Use this when polling the metrics of the same
+                             segments repeatedly. Stop the listeners with `stop_listening_to_messages_metrics`.
+                             Defaults to False.
+        :type use_listener: bool, optional
         :return: Messages metrics for a given segment
         :rtype: core_data_modules.data_models.metrics.MessagesMetrics
         """
-        messages_metrics = self.get_segment_messages_metrics_ref(segment_id).get(transaction=transaction).to_dict()
-        if messages_metrics is None:
+        if transaction is None and use_listener:
+            # Only serve metrics seen by a listener that is still running, as they would otherwise never be refreshed.
+            with self._metrics_watches_lock:
+                if segment_id in self._metrics_watches and segment_id in self._watched_metrics:
+                    return self._watched_metrics[segment_id]
+            self._listen_to_messages_metrics(segment_id)
+
+        messages_metrics_snapshot = self.get_segment_messages_metrics_ref(segment_id).get(transaction=transaction)
+        if not messages_metrics_snapshot.exists:
             return None
-        return MessagesMetrics.from_firebase_map(messages_metrics)
+        return MessagesMetrics.from_firebase_map(messages_metrics_snapshot.to_dict())
+
+    def _listen_to_messages_metrics(self, segment_id):
+        # Starts a snapshot listener which keeps `self._watched_metrics[segment_id]` up to date with the segment's
+        # metrics, if one isn't running already.
+        # The listener's watch, once started. Snapshots that arrive after this watch has been stopped are ignored, so
+        # that they can't repopulate `self._watched_metrics`.
+        watch = None
+
+        def on_snapshot(doc_snapshots, changes, read_time):
+            with self._metrics_watches_lock:
+                if watch is None or self._metrics_watches.get(segment_id) is not watch:
+                    return
+                for doc_snapshot in doc_snapshots:
+                    if doc_snapshot.exists:
+                        self._watched_metrics[segment_id] = MessagesMetrics.from_firebase_map(doc_snapshot.to_dict())
+                    else:
+                        self._watched_metrics[segment_id] = None
+
+        with self._metrics_watches_lock:
+            if segment_id not in self._metrics_watches:
+                log.debug(f"Listening to messages metrics of segment {segment_id}")
+                watch = self.get_segment_messages_metrics_ref(segment_id).on_snapshot(on_snapshot)
+                self._metrics_watches[segment_id] = watch
+
+    def stop_listening_to_messages_metrics(self):
+        """
+        Stops all the snapshot listeners started by `get_segment_messages_metrics(..., use_listener=True)`.
+        """
+        with self._metrics_watches_lock:
+            watches = list(self._metrics_watches.values())
+            self._metrics_watches.clear()
+            self._watched_metrics.clear()
+
+        # Unsubscribe without holding the lock, because a snapshot callback may be waiting for it on the watch thread
+        # being stopped. The callbacks ignore any snapshots they receive now that their watches have been removed.
+        for watch in watches:
+            watch.unsubscribe()
 
     def set_segment_messages_metrics(self, segment_id, messages_metrics, transaction=None):
         """
@@ -602,23 +1220,43 @@ class CodaV2Client:
         :return: Message metrics for a single message.
         :rtype: core_data_modules.data_models.metrics.MessageMetrics
         """
+        return CodaV2Client._compute_message_metrics_with_codes_lut(message, CodaV2Client._build_codes_lut(code_schemes))
+
+    @staticmethod
+    def _build_codes_lut(code_schemes):
+        # Builds a look-up table of (scheme id, code id) -> code, so that the code for a label can be found without
+        # searching its code scheme. Callers computing metrics for many messages should build this once and reuse it.
+        return {
+            (code_scheme.scheme_id, code.code_id): code
+            for code_scheme in code_schemes
+            for code in code_scheme.codes
+        }
+
+    @staticmethod
+    def _compute_message_metrics_with_codes_lut(message, codes_lut):
+        # Computes the MessageMetrics for a single message, given a look-up table built by `_build_codes_lut`.
+        message_has_label, message_has_ws, message_has_nc = CodaV2Client._message_metrics_flags(message, codes_lut)
+        return MessagesMetrics(
+            messages_count=1,
+            messages_with_label=1 if message_has_label else 0,
+            not_coded_messages=1 if message_has_nc else 0,
+            wrong_scheme_messages=1 if message_has_ws else 0
+        )
+
+    @staticmethod
+    def _message_metrics_flags(message, codes_lut):
+        # Returns whether a message has a checked label, a WS label, and an NC label, given a look-up table built by
+        # `_build_codes_lut`. Loops over many messages can count these directly rather than summing MessagesMetrics.
         message_has_label = False
         message_has_ws = False
         message_has_nc = False
 
-        code_schemes_lut = {code_scheme.scheme_id: code_scheme for code_scheme in code_schemes}
-
         for label in message.get_latest_labels():
             if not label.checked:
                 continue
 
             message_has_label = True
-            code_scheme_for_label = code_schemes_lut[label.scheme_id]
-            code_for_label = None
-
-            for code in code_scheme_for_label.codes:
-                if label.code_id == code.code_id:
-                    code_for_label = code
+            code_for_label = codes_lut.get((label.scheme_id, label.code_id))
 
             assert code_for_label is not None
             if code_for_label.code_type == "Control":
@@ -627,14 +1265,9 @@ class CodaV2Client:
                 if code_for_label.control_code == "NC":
                     message_has_nc = True
 
-        return MessagesMetrics(
-            messages_count=1,
-            messages_with_label=1 if message_has_label else 0,
-            not_coded_messages=1 if message_has_nc else 0,
-            wrong_scheme_messages=1 if message_has_ws else 0
-        )
+        return message_has_label, message_has_ws, message_has_nc
 
-    def compute_segment_messages_metrics(self, segment_id, messages=None, transaction=None):
+    def compute_segment_messages_metrics(self, segment_id, messages=None, transaction=None, code_schemes=None):
         """
         Compute and return the messages metrics for a given dataset.
 
@@ -645,25 +1278,48 @@ class CodaV2Client:
         :param messages: list of core_data_modules.data_models.message.Message, defaults to None
                          If specified, it computes progress metrics based on the provided messages
                          else it downloads messages from the requested segment. Defaults to None.
-        :type messages: core_data_modules.data_models.message.Message | None
+        :type messages: iterable of core_data_modules.data_models.message.Message | None
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
+        :param code_schemes: Code schemes of the segment, if already known by the caller. If None, the code schemes are
+                             downloaded from the segment. Defaults to None.
+        :type code_schemes: list of core_data_modules.data_models.code_scheme.CodeScheme | None
         :return: Messages metrics.
         :rtype: core_data_modules.data_models.metrics.MessagesMetrics
         """
         if messages is None:
-            messages = self.get_segment_messages(segment_id, transaction=transaction)
-
-        if len(messages) == 0:
-            return MessagesMetrics(0, 0, 0, 0)
-
-        code_schemes = self.get_all_code_schemes(segment_id, transaction=transaction)
-
-        segment_metrics = MessagesMetrics(0, 0, 0, 0)
+            # Count the messages as they are downloaded, so the segment's messages don't all need to be held in memory.
+            messages = self.iter_segment_messages(segment_id, transaction=transaction)
+
+        # Count the messages in plain ints, and only build a MessagesMetrics once at the end.
+        messages_count = 0
+        messages_with_label = 0
+        wrong_scheme_messages = 0
+        not_coded_messages = 0
+        codes_lut = None
         for message in messages:
-            segment_metrics += CodaV2Client.compute_message_metrics(message, code_schemes)
+            if codes_lut is None:
+                # Only get the code schemes once there is a message to look them up for, so that empty segments don't
+                # need them.
+                if code_schemes is None:
+                    code_schemes = self.get_all_code_schemes(segment_id, transaction=transaction)
+                codes_lut = CodaV2Client._build_codes_lut(code_schemes)
+
+            messages_count += 1
+            message_has_label, message_has_ws, message_has_nc = CodaV2Client._message_metrics_flags(message, codes_lut)
+            if message_has_label:
+                messages_with_label += 1
+            if message_has_ws:
+                wrong_scheme_messages += 1
+            if message_has_nc:
+                not_coded_messages += 1
 
-        return segment_metrics
+        return MessagesMetrics(
+            messages_count=messages_count,
+            messages_with_label=messages_with_label,
+            not_coded_messages=not_coded_messages,
+            wrong_scheme_messages=wrong_scheme_messages
+        )
 
     def compute_and_update_dataset_messages_metrics(self, dataset_id):
         """
@@ -672,11 +1328,27 @@ class CodaV2Client:
         :param dataset_id: Id of the dataset to compute coding progress.
         :type dataset_id: str
         """
-        segment_count = self.get_segment_count(dataset_id)
-        for segment_index in range(1, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            messages_metrics = self.compute_segment_messages_metrics(segment_id)
-            self.set_segment_messages_metrics(segment_id, messages_metrics)
+        # Read the segment count from Firestore rather than the cache, so that every segment's metrics are updated.
+        segment_count = self.get_segment_count(dataset_id, use_cache=False)
+        segment_ids = self._segment_ids(dataset_id, segment_count)
+
+        # Every segment has the same code schemes, so download (and check) them once for the whole dataset.
+        code_schemes = self.get_all_code_schemes(dataset_id, segment_count=segment_count)
+
+        # Compute the metrics for all the segments concurrently, then write them all in a single batch where possible.
+        # Datasets with more segments than fit in one batch are written in as few batches as possible.
+        with ThreadPoolExecutor(max_workers=min(segment_count, self.MAX_SEGMENT_READ_WORKERS)) as executor:
+            segments_messages_metrics = list(executor.map(
+                lambda segment_id: self.compute_segment_messages_metrics(segment_id, code_schemes=code_schemes),
+                segment_ids
+            ))
+
+        for i in range(0, segment_count, self.MAX_BATCH_WRITES):
+            batch = self._client.batch()
+            for segment_id, messages_metrics in zip(segment_ids[i:i + self.MAX_BATCH_WRITES],
+                                                    segments_messages_metrics[i:i + self.MAX_BATCH_WRITES]):
+                self.set_segment_messages_metrics(segment_id, messages_metrics, transaction=batch)
+            batch.commit()
 
     def get_segment_ref(self, segment_id):
         """
@@ -687,29 +1359,51 @@ class CodaV2Client:
         :return: A reference to a document in a Firestore database
         :rtype: google.cloud.firestore.DocumentReference
         """
-        return self._client.document(f"datasets/{segment_id}")
+        return self._datasets_ref.document(segment_id)
 
-    def get_segment(self, segment_id, transaction=None):
+    def get_segment(self, segment_id, transaction=None, use_cache=False):
         """
         Gets segment by id.
 
+        Segments read outside of a transaction with `use_cache` set are cached for `SEGMENT_CACHE_TTL_SECONDS`. The
+        cache is only used if requested, because segments written by other clients in the meantime won't be seen.
+
         :param segment_id: Id of a segment.
         :type segment_id: str
+        :param transaction: Transaction to run this get in. Transactional gets always read from Firestore.
+        :type transaction: google.cloud.firestore.Transaction | None
+        :param use_cache: Whether to return a cached segment if a fresh one is available. Defaults to False.
+        :type use_cache: bool, optional
         :return: A snapshot of document data in a Firestore database.
         :rtype: google.cloud.firestore.DocumentSnapshot
         """
-        return self.get_segment_ref(segment_id).get(transaction=transaction)
+        if transaction is None and use_cache and segment_id in self._segment_cache:
+            segment_snapshot, cached_at = self._segment_cache[segment_id]
+            if time.monotonic() - cached_at < self.SEGMENT_CACHE_TTL_SECONDS:
+                return segment_snapshot
+
+        segment_snapshot = self.get_segment_ref(segment_id).get(transaction=transaction)
+        if transaction is None and use_cache:
+            # Drop expired segments, so that segments which are no longer read don't accumulate.
+            now = time.monotonic()
+            for cached_segment_id, (_, cached_at) in list(self._segment_cache.items()):
+                if now - cached_at >= self.SEGMENT_CACHE_TTL_SECONDS:
+                    del self._segment_cache[cached_segment_id]
+            self._segment_cache[segment_id] = (segment_snapshot, now)
+        return segment_snapshot
 
-    def get_segment_user_ids(self, segment_id, transaction=None):
+    def get_segment_user_ids(self, segment_id, transaction=None, use_cache=False):
         """
         Gets user id in the given segment.
 
         :param segment_id: Id of a segment.
         :type segment_id: str
+        :param use_cache: Whether to read the segment from the segment cache (see `get_segment`). Defaults to False.
+        :type use_cache: bool, optional
         :return: list of user ids.
         :rtype: list
         """
-        return self.get_segment(segment_id, transaction=transaction).get("users")
+        return self.get_segment(segment_id, transaction=transaction, use_cache=use_cache).get("users")
 
     def ensure_user_ids_consistent(self, dataset_id, transaction=None):
         """
@@ -720,18 +1414,27 @@ class CodaV2Client:
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
         """
-        # Perform a consistency check on the other segments if they exist
-        segment_count = self.get_segment_count(dataset_id)
+        # Perform a consistency check on the other segments if they exist. Read the count from Firestore rather than
+        # the cache, so that the newest segment isn't skipped.
+        segment_count = self.get_segment_count(dataset_id, use_cache=False)
         if segment_count == 1:
             return
 
-        first_segment_users = self.get_segment_user_ids(dataset_id, transaction=transaction)
-        for segment_index in range(2, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            assert set(self.get_segment_user_ids(segment_id, transaction=transaction)) == set(first_segment_users), \
+        # Fetch just the users of every segment in a single batched request. get_all doesn't return snapshots in the
+        # order requested, so key them by segment id.
+        segment_refs = [self.get_segment_ref(segment_id) for segment_id in self._segment_ids(dataset_id, segment_count)]
+        users_by_segment = {
+            segment_snapshot.id: set(segment_snapshot.get("users"))
+            for segment_snapshot in self._client.get_all(segment_refs, field_paths=["users"], transaction=transaction)
+        }
+
+        first_segment_users = users_by_segment[dataset_id]
+        for segment_ref in segment_refs[1:]:
+            segment_id = segment_ref.id
+            assert users_by_segment[segment_id] == first_segment_users, \
                 f"Segment {segment_id} has different users to the first segment {dataset_id}"
 
-    def get_dataset_user_ids(self, dataset_id, transaction=None):
+    def get_dataset_user_ids(self, dataset_id, transaction=None, use_cache=False, check_consistency=True):
         """
         Gets user ids for the given dataset.
 
@@ -739,12 +1442,19 @@ class CodaV2Client:
         :type dataset_id: str
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
+        :param use_cache: Whether to read the first segment from the segment cache (see `get_segment`).
+                          Defaults to False.
+        :type use_cache: bool, optional
+        :param check_consistency: Whether to check that the user ids are the same in all the dataset's segments
+                                  (see `ensure_user_ids_consistent`). Defaults to True.
+        :type check_consistency: bool, optional
         :return: list of user ids.
         :rtype: list | None
         """
-        self.ensure_user_ids_consistent(dataset_id, transaction=transaction)
+        if check_consistency:
+            self.ensure_user_ids_consistent(dataset_id, transaction=transaction)
 
-        segment_snapshot = self.get_segment(dataset_id, transaction=transaction)
+        segment_snapshot = self.get_segment(dataset_id, transaction=transaction, use_cache=use_cache)
         if not segment_snapshot.exists:
             return None
 
@@ -762,14 +1472,35 @@ class CodaV2Client:
         :param user_ids: list of user ids.
         :type user_ids: list
         """
-        segment_count = self.get_segment_count(dataset_id)
-        batch = self._client.batch()
-
-        for segment_index in range(1, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            batch.set(self.get_segment_ref(segment_id), {"users": user_ids})
+        # Read the segment count from Firestore rather than the cache, because the users must be written to every
+        # segment for the segments to stay consistent.
+        segment_count = self.get_segment_count(dataset_id, use_cache=False)
+        segment_refs = [self.get_segment_ref(segment_id) for segment_id in self._segment_ids(dataset_id, segment_count)]
+
+        # Fetch the current users of every segment in a single batched request, and only write to the segments whose
+        # users are changing.
+        unchanged_segment_ids = {
+            segment_snapshot.id
+            for segment_snapshot in self._client.get_all(segment_refs, field_paths=["users"])
+            if segment_snapshot.exists and segment_snapshot.to_dict().get("users") == user_ids
+        }
+        if len(unchanged_segment_ids) == segment_count:
+            log.debug(f"Users of dataset {dataset_id} are unchanged, not writing")
+            return
 
-        batch.commit()
+        # Write all the segments in a single atomic batch where possible, so that the segments are updated together.
+        # Datasets with more segments than fit in one batch are written in as few batches as possible.
+        changed_segment_refs = [
+            segment_ref for segment_ref in segment_refs if segment_ref.id not in unchanged_segment_ids
+        ]
+        for i in range(0, len(changed_segment_refs), self.MAX_BATCH_WRITES):
+            batch = self._client.batch()
+            for segment_ref in changed_segment_refs[i:i + self.MAX_BATCH_WRITES]:
+                batch.set(segment_ref, {"users": user_ids})
+            batch.commit()
+
+        for segment_ref in segment_refs:
+            self._segment_cache.pop(segment_ref.id, None)
         log.debug(f"Wrote {len(user_ids)} users to dataset {dataset_id}")
 
     def set_segment_user_ids(self, segment_id, user_ids, transaction=None):
@@ -784,7 +1515,11 @@ class CodaV2Client:
                             If None, adds the updates to a transaction that will then be explicitly committed.
         :type transaction: google.cloud.firestore.Transaction | None
         """
-        if transaction is None:
+        if transaction is None and self._in_batched_writes():
+            # Add the update to the batch of the current `batched_writes` block, which commits it later.
+            transaction = self._get_batched_writes_batch()
+            commit_before_returning = False
+        elif transaction is None:
             # If no transaction was given, run all the updates in a new batched-write transaction and flag that
             # this transaction needs to be committed before returning from this function.
             transaction = self._client.batch()
@@ -796,37 +1531,82 @@ class CodaV2Client:
 
         if commit_before_returning:
             transaction.commit()
+        self._segment_cache.pop(segment_id, None)
 
         log.debug(f"Wrote {len(user_ids)} users to dataset {segment_id}")
 
-    def get_next_available_sequence_number(self, dataset_id, transaction=None):
+    def get_next_available_sequence_number(self, dataset_id, transaction=None, segment_count=None):
         """
         Gets the sequence number of message being added to the given dataset.
         :param dataset_id: Id of a dataset.
         :type dataset_id: str
         :param transaction: Transaction to run this get in.
         :type transaction: google.cloud.firestore.Transaction
+        :param segment_count: Number of segments in the dataset, if already known by the caller. If None, the segment
+                              count is read from Firestore, bypassing the segment count cache. Defaults to None.
+        :type segment_count: int | None, optional
         :return: sequence number.
         :rtype: int
         """
-        segment_count = self.get_segment_count(dataset_id, transaction=transaction)
+        if segment_count is None:
+            # Read the count from Firestore rather than the cache, so that a stale count can't lead to a sequence
+            # number that is already used in a segment another client has just created.
+            segment_count = self.get_segment_count(dataset_id, transaction=transaction, use_cache=False)
+
+        # Messages are only ever added to the latest segment, so once a later segment exists the highest sequence
+        # number in a segment can't change. Query the latest segment and any earlier segments whose highest sequence
+        # number hasn't been found recently, and remember the results for the earlier segments for
+        # `FILLED_SEGMENT_SEQ_NOS_CACHE_TTL_SECONDS`.
+        segment_ids = self._segment_ids(dataset_id, segment_count)
+        latest_segment_id = segment_ids[-1]
+
+        # Drop expired results, so that results for datasets which are no longer used don't accumulate.
+        now = time.monotonic()
+        for cached_dataset_id, (_, cached_at) in list(self._filled_segment_highest_seq_nos.items()):
+            if now - cached_at >= self.FILLED_SEGMENT_SEQ_NOS_CACHE_TTL_SECONDS:
+                del self._filled_segment_highest_seq_nos[cached_dataset_id]
+
+        # If a segment we have a result for is no longer a filled segment, the dataset has been replaced or changed
+        # since, so start again.
+        filled_segment_seq_nos, cached_at = self._filled_segment_highest_seq_nos.get(dataset_id, (dict(), now))
+        if not set(filled_segment_seq_nos).issubset(segment_ids[:-1]):
+            filled_segment_seq_nos, cached_at = dict(), now
+
+        query_segment_ids = [segment_id for segment_id in segment_ids[:-1] if segment_id not in filled_segment_seq_nos]
+        query_segment_ids.append(latest_segment_id)
+
+        # Query for the message with the highest sequence number in each segment.
+        direction = firestore.Query.DESCENDING
+        queries = [
+            self.get_messages_ref(segment_id).order_by("SequenceNumber", direction=direction).limit(1)
+            for segment_id in query_segment_ids
+        ]
+        if transaction is None and len(queries) > 1:
+            # The queries are independent, so run them concurrently.
+            with ThreadPoolExecutor(max_workers=min(len(queries), self.MAX_SEGMENT_READ_WORKERS)) as executor:
+                message_snapshots_list = list(executor.map(lambda query: query.get(), queries))
+        else:
+            # Transactions can't be shared between threads, so query in sequence.
+            message_snapshots_list = [query.get(transaction=transaction) for query in queries]
 
         highest_seq_no = -1
-        for segment_index in range(1, segment_count + 1):
-            segment_id = self.id_for_segment(dataset_id, segment_index)
-            messages_ref = self.get_messages_ref(segment_id)
+        for segment_id, message_snapshots in zip(query_segment_ids, message_snapshots_list):
+            segment_highest_seq_no = -1
+            if len(message_snapshots) > 0:
+                [msg_snapshot] = message_snapshots
+                segment_highest_seq_no = Message.from_firebase_map(msg_snapshot.to_dict()).sequence_number
 
-            direction = firestore.Query.DESCENDING
-            message_snapshots = messages_ref.order_by(
-                "SequenceNumber", direction=direction).limit(1).get(transaction=transaction)
+            if segment_id != latest_segment_id:
+                filled_segment_seq_nos[segment_id] = segment_highest_seq_no
+            if segment_highest_seq_no > highest_seq_no:
+                highest_seq_no = segment_highest_seq_no
 
-            if len(message_snapshots) == 0:
-                continue
+        for segment_highest_seq_no in filled_segment_seq_nos.values():
+            if segment_highest_seq_no > highest_seq_no:
+                highest_seq_no = segment_highest_seq_no
 
-            [msg_snapshot] = message_snapshots
-            message = Message.from_firebase_map(msg_snapshot.to_dict())
-            if message.sequence_number > highest_seq_no:
-                highest_seq_no = message.sequence_number
+        if len(filled_segment_seq_nos) > 0:
+            self._filled_segment_highest_seq_nos[dataset_id] = (filled_segment_seq_nos, cached_at)
 
         return highest_seq_no + 1
 
@@ -834,6 +1614,12 @@ class CodaV2Client:
         """
         Adds message to a given dataset.
 
+        Messages are added without a transaction where possible. Instead, the write is made conditional on the latest
+        segment's metrics not having changed since they were read. Every add (and every message update) writes to
+        those metrics, so concurrent writes to the same segment conflict, and the losers retry after a short random
+        delay. A transaction is used when the latest segment is full and the next segment needs to be created, or if
+        the message still couldn't be added after `ADD_MESSAGE_MAX_ATTEMPTS` attempts.
+
         :param dataset_id: Id of the dataset to add the message into.
         :type dataset_id: str
         :param message: The message to be added.
@@ -841,30 +1627,63 @@ class CodaV2Client:
         """
         message = message.copy()
 
+        for attempt in range(1, self.ADD_MESSAGE_MAX_ATTEMPTS + 1):
+            try:
+                if self._add_message_to_latest_segment(dataset_id, message):
+                    return
+                break
+            except (exceptions.FailedPrecondition, exceptions.AlreadyExists):
+                if attempt == self.ADD_MESSAGE_MAX_ATTEMPTS:
+                    log.debug(f"Latest segment of dataset {dataset_id} was written to while adding message "
+                              f"{message.message_id} on every attempt, adding it in a transaction instead")
+                    break
+                log.debug(f"Latest segment of dataset {dataset_id} was written to while adding message "
+                          f"{message.message_id}, retrying (attempt {attempt}/{self.ADD_MESSAGE_MAX_ATTEMPTS})")
+                max_delay = min(
+                    self.ADD_MESSAGE_RETRY_INITIAL_DELAY_SECONDS * 2 ** (attempt - 1),
+                    self.ADD_MESSAGE_RETRY_MAX_DELAY_SECONDS
+                )
+                time.sleep(random.uniform(0, max_delay))
+
+        # Either the latest segment is full, or the conditional writes above kept conflicting with other writes to it,
+        # so add the message in a transaction, which also creates the next segment if needed.
         @firestore.transactional
         def add_in_transaction(transaction):
             message_id = message.message_id
 
-            message_exists = self.get_dataset_message(dataset_id, message_id, transaction=transaction) is not None
+            # Read the segment count once, and pass it to the helpers below so they don't each read it again.
+            segment_count = self.get_segment_count(dataset_id, transaction=transaction)
+
+            message_exists = self.get_dataset_message(
+                dataset_id, message_id, transaction=transaction, segment_count=segment_count
+            ) is not None
             assert not message_exists, f"message with id {message_id} already exists."
 
             log.debug(f"Adding message with id {message_id} to Coda dataset {dataset_id}")
 
-            segment_count = self.get_segment_count(dataset_id, transaction=transaction)
             latest_segment_id = self.id_for_segment(dataset_id, segment_count)
 
-            message.last_updated = firestore.firestore.SERVER_TIMESTAMP
-            message.sequence_number = self.get_next_available_sequence_number(dataset_id, transaction=transaction)
-            message_metrics = self.compute_segment_messages_metrics(latest_segment_id, [message], transaction=transaction)  # nopep8
-
+            # Read the latest segment's stored metrics first. The full segment only needs to be downloaded to compute
+            # them if they haven't been stored yet.
             segment_messages_metrics = self.get_segment_messages_metrics(latest_segment_id, transaction=transaction)
             if segment_messages_metrics is None:
                 segment_messages_metrics = self.compute_segment_messages_metrics(latest_segment_id, transaction=transaction)  # nopep8
 
+            message.last_updated = firestore.SERVER_TIMESTAMP
+            message.sequence_number = self.get_next_available_sequence_number(
+                dataset_id, transaction=transaction, segment_count=segment_count
+            )
+            message_metrics = self.compute_segment_messages_metrics(latest_segment_id, [message], transaction=transaction)  # nopep8
+
             latest_segment_size = segment_messages_metrics.messages_count
             if latest_segment_size >= self.MAX_SEGMENT_SIZE:
                 # Any read operation after this will raise ReadAfterWriteError
                 self.create_next_segment(dataset_id, transaction=transaction)
+
+                # Rewrite the full segment's metrics, so that the conditional writes of any concurrent
+                # `_add_message_to_latest_segment` calls which are still adding to the full segment fail and retry.
+                self.set_segment_messages_metrics(latest_segment_id, segment_messages_metrics, transaction=transaction)
+
                 latest_segment_id = self.id_for_segment(dataset_id, segment_count + 1)
                 segment_messages_metrics = MessagesMetrics(0, 0, 0, 0)
 
@@ -878,3 +1697,48 @@ class CodaV2Client:
             transaction.set(segment_messages_metrics_ref, updated_messages_metrics.to_firebase_map())
 
         add_in_transaction(self.transaction())
+
+    def _add_message_to_latest_segment(self, dataset_id, message):
+        # Adds a message to the latest segment of a dataset in a batched write which only succeeds if the latest
+        # segment's metrics are unchanged since they were read. Returns False without writing anything if the latest
+        # segment is full. Raises google.api_core.exceptions.FailedPrecondition or AlreadyExists if another client
+        # wrote to the latest segment in the meantime.
+        message_id = message.message_id
+
+        # Read the segment count from Firestore rather than the cache, so that a stale count can't lead to the
+        # message being written to a segment that has since been filled.
+        segment_count = self.get_segment_count(dataset_id, use_cache=False)
+
+        message_exists = self.get_dataset_message(dataset_id, message_id, segment_count=segment_count) is not None
+        assert not message_exists, f"message with id {message_id} already exists."
+
+        latest_segment_id = self.id_for_segment(dataset_id, segment_count)
+        segment_messages_metrics_ref = self.get_segment_messages_metrics_ref(latest_segment_id)
+        segment_messages_metrics_snapshot = segment_messages_metrics_ref.get()
+        if segment_messages_metrics_snapshot.exists:
+            segment_messages_metrics = MessagesMetrics.from_firebase_map(segment_messages_metrics_snapshot.to_dict())
+        else:
+            segment_messages_metrics = self.compute_segment_messages_metrics(latest_segment_id)
+
+        if segment_messages_metrics.messages_count >= self.MAX_SEGMENT_SIZE:
+            return False
+
+        log.debug(f"Adding message with id {message_id} to Coda dataset {dataset_id}")
+
+        message.last_updated = firestore.SERVER_TIMESTAMP
+        message.sequence_number = self.get_next_available_sequence_number(dataset_id, segment_count=segment_count)
+        message_metrics = self.compute_segment_messages_metrics(latest_segment_id, [message])
+        updated_messages_metrics = segment_messages_metrics + message_metrics
+
+        batch = self._client.batch()
+        batch.create(self.get_message_ref(latest_segment_id, message_id), message.to_firebase_map())
+        if segment_messages_metrics_snapshot.exists:
+            batch.update(
+                segment_messages_metrics_ref, updated_messages_metrics.to_firebase_map(),
+                option=self._client.write_option(last_update_time=segment_messages_metrics_snapshot.update_time)
+            )
+        else:
+            batch.create(segment_messages_metrics_ref, updated_messages_metrics.to_firebase_map())
+        batch.commit()
+
+        return True
@@ -5,5 +5,6 @@ setup(
     version="0.1.5",
     url="https://github.com/AfricasVoices/CodaV2PythonClient",
     packages=["coda_v2_python_client"],
-    install_requires=["firebase_admin", "coredatamodules @ git+https://github.com/AfricasVoices/CoreDataModules"]
+    install_requires=["firebase_admin", "google-cloud-firestore>=2.3.0", "google-api-core",
+                      "coredatamodules @ git+https://github.com/AfricasVoices/CoreDataModules"]
 )